@@ -1,11 +1,79 @@
-from collections import defaultdict
-from itertools import combinations
+from array import array
+import random
 
 from tools import Card
-from tools import choose_random
+from tools import choose_random_action, choose_random_card
+from tools import FULL_MASK, EXPAND_VALUES, card_bit, iter_cards, iter_bits, popcount
 from players import Random, Human, ISMCTSFPV, DeterminizedMCTS, ISMCTS
 
 
+# All (suit, value) pairs of the cards in the game
+ALL_CARDS = frozenset((suit, value) for suit in range(4) for value in range(9))
+
+# Random 64-bit keys for the incremental (Zobrist) hash of the history of a game.
+# There is a key for each (action, card index, player index), where card index 36
+# is used for actions without a card. After each action the hash is multiplied by
+# an odd constant, such that the hash depends on the order of the actions (a plain
+# XOR would give equal hashes for reordered histories and cancel repeated actions).
+_zobrist_random = random.Random(0)  # does not touch the global random state
+ZOBRIST_ACTIONS = {action: idx for idx, action in enumerate(
+    ['Attack', 'Defend', 'Take', 'ThrowCards', 'PassAttack', 'Reflect', 'ReflectTrump'])}
+ZOBRIST_KEYS = [[[_zobrist_random.getrandbits(64) for player in range(6)]
+                    for card in range(37)] for action in ZOBRIST_ACTIONS]
+ZOBRIST_MULTIPLIER = 0x9E3779B97F4A7C15  # odd, thus no information is lost
+ZOBRIST_MASK = (1 << 64) - 1
+
+def _defend_mask(trump, suit, value):
+    """Returns the bitboard of the cards that can defend the card (suit, value)"""
+    mask = 0
+    for s in range(4):
+        for v in range(9):
+            # You can always play a trump on a non-trump card to win, and a
+            # higher card of the same suit
+            if (s == trump and suit != trump) or (s == suit and v > value):
+                mask |= card_bit(s, v)
+    return mask
+
+# The cards that can defend a card for each trump suit (4 if the card does
+# not know the trump suit) and index of the card to defend.
+DEFEND_MASKS = [[_defend_mask(trump, suit, value) for suit in range(4) for value in range(9)]
+                    for trump in range(5)]
+
+def throw_subsets(n, max_throws):
+    """Returns the subsets of range(n) with 1 up to max_throws elements
+
+    The subsets are (mask, indices) pairs ordered by size, these are cached
+    for small n, as the same subsets are asked for over and over again.
+    """
+    key = (n, max_throws)
+    if key in THROW_SUBSETS:
+        return THROW_SUBSETS[key]
+
+    subsets = []
+    for throw in range(1, max_throws + 1):
+        # Iterate the masks of n bits with `throw` set bits (Gosper's hack)
+        subset = (1 << throw) - 1
+        while subset < 1 << n:
+            subsets.append((subset, tuple(iter_bits(subset))))
+            # The next subset with the same number of elements
+            low = subset & -subset
+            ripple = subset + low
+            subset = (((ripple ^ subset) >> 2) // low) | ripple
+    if n <= THROW_SUBSETS_MAX_N:
+        THROW_SUBSETS[key] = subsets
+    return subsets
+
+# Cache of throw_subsets, only for up to 16 possible throws (at most 14892
+# subsets each) to bound its memory.
+THROW_SUBSETS = {}
+THROW_SUBSETS_MAX_N = 16
+
+# The allowed plays of all positions seen, shared by all game states (e.g. the
+# MCTS rollouts and determinizations), cleared once it holds too many positions.
+ALLOWED_PLAYS_CACHE = {}
+ALLOWED_PLAYS_CACHE_SIZE = 2**18
+
+
 class GameTree:
     """The main tree for the game durak
 
@@ -17,9 +85,19 @@ class GameTree:
                                 it to the computer.
         - main_attacker:    The name of the starting attacker
     """
-    is_end_state = False
-    loser = None  # The loser/durak of the game once known
-    print_info = True
+    __slots__ = ('players', 'name_to_idx', 'computer_shuffle', 'print_info', 'deck',
+                 'all_cards', 'card_collection', 'known_mask', 'public_mask', 'history',
+                 'zobrist', 'is_end_state', 'loser', 'attackers', 'defender',
+                 'current_attacker', 'player_to_play', 'draw_order',
+                 'attacker_to_start_throwing', 'last_played_attacker', 'reflected_trumps',
+                 'current_action', 'pairs_attack', 'pairs_defend', 'cards_to_defend_idx',
+                 'values_on_table')
+
+    def __new__(cls, players=None, *args, **kwargs):
+        # Games with two players use the specialized GameTree2P
+        if cls is GameTree and isinstance(players, list) and len(players) == 2:
+            cls = GameTree2P
+        return super().__new__(cls)
 
     def __init__(self, players, computer_shuffle, main_attacker, do_init=True, print_info=True):
         if not do_init:  # Terminate the init (for make_deepcopy)
@@ -27,40 +105,52 @@ class GameTree:
 
         self.players = players
         assert 2 <= len(self.players) <= 6  # No fun to cards run out
+        # The index of each player in self.players by their name
+        self.name_to_idx = {player.name: idx for idx, player in enumerate(players)}
         self.computer_shuffle = computer_shuffle
         self.print_info = print_info
+        self.is_end_state = False
+        self.loser = None  # The loser/durak of the game once known
 
         # Initialize the deck
         self.deck = [Card() for _ in range(36)]
-        # Initialize a collection of all cards
-        self.all_cards = {(suit, value) for suit in range(4) for value in range(9)}
+        for idx, card in enumerate(self.deck):
+            card.idx = idx
+        # The collection of all cards (shared by all games)
+        self.all_cards = ALL_CARDS
         # Initialize an array with all cards, stored (nothing is
         # removed or added to this list), it functions as a collective
         # of which cards are known/private/public.
         self.card_collection = self.deck.copy()
-        # Keep track of all the actions played this game
+        # Bitboards of the cards that are known (to anyone) and public (to all),
+        # these must be kept in sync with the flags of the cards.
+        self.known_mask = 0
+        self.public_mask = 0
+        # Keep track of all the actions played this game (and their hash)
         self.history = []
+        self.zobrist = 0
 
         # Initialize the last/bottom card of the deck
-        if computer_shuffle:
-            unknown = self.get_unknown_cards()
-            # At this point, unknown should equal all the (suit, value) pairs
-            assert self.all_cards == unknown
-            # Initialize the card as random card from all cards
-            self.deck[-1].from_suit_value(*choose_random(unknown))
-            self.deck[-1].is_public = True
-        else:
-            print('Specify the suit and value of the bottom card')
-            self.deck[-1].from_input(self.all_cards)
-            self.deck[-1].is_public = True
+        while True:
+            if computer_shuffle:
+                unknown = self.get_unknown_cards()
+                # At this point, unknown should equal all the (suit, value) pairs
+                assert unknown == FULL_MASK
+                # Initialize the card as random card from all cards
+                self.deck[-1].from_suit_value(*choose_random_card(unknown))
+                self.mark_public(self.deck[-1])
+            else:
+                print('Specify the suit and value of the bottom card')
+                self.deck[-1].from_input(self.all_cards)
+                self.mark_public(self.deck[-1])
 
-        # Check if the bottom card is an ace
-        if self.deck[-1].value == 8:
-            # If so, redeal
+            # Check if the bottom card is an ace
+            if self.deck[-1].value != 8:
+                break
+            # If so, redeal (only the bottom card is known at this point)
             if self.print_info:
                 print('There was an ace on the bottom, redealing...')
-            GameTree.__init__(self, players, computer_shuffle, main_attacker, print_info=self.print_info)
-            return None
+            self.mark_unknown(self.deck[-1])
 
         # Display the bottom card
         if self.print_info:
@@ -82,40 +172,81 @@ class GameTree:
 
 
     def get_unknown_cards(self):
-        """Returns the (suit, value) pairs of all unknown cards"""
-        # remove = set()
-        # for card in self.card_collection:
-        #     if not card.is_unknown:
-        #         remove.add((card.suit, card.value))
-        remove = {(c.suit, c.value) for c in self.card_collection if not c.is_unknown}
-        return self.all_cards - remove
+        """Returns the bitboard of all unknown cards"""
+        return FULL_MASK & ~self.known_mask
 
     def get_non_public_cards(self):
-        """Returns the (suit, value) pairs of all unknown cards + private cards"""
-        # remove = set()
-        # for card in self.card_collection:
-        #     if card.is_public:
-        #         remove.add((card.suit, card.value))
-        remove = {(c.suit, c.value) for c in self.card_collection if c.is_public}
-        return self.all_cards - remove
+        """Returns the bitboard of all unknown cards + private cards"""
+        return FULL_MASK & ~self.public_mask
+
+    def mark_public(self, card):
+        """Makes the (identified) card known to everyone"""
+        card.is_unknown = False
+        card.is_private = False
+        card.is_public = True
+        bit = card_bit(card.suit, card.value)
+        self.known_mask |= bit
+        self.public_mask |= bit
+
+    def mark_private(self, card):
+        """Makes the (identified) card known to the person holding it only"""
+        card.is_unknown = False
+        card.is_private = True
+        card.is_public = False
+        bit = card_bit(card.suit, card.value)
+        self.known_mask |= bit
+        self.public_mask &= ~bit
+
+    def mark_unknown(self, card):
+        """Makes the card unknown to everyone (keeping the same memory address)"""
+        if not card.is_unknown:
+            bit = card_bit(card.suit, card.value)
+            self.known_mask &= ~bit
+            self.public_mask &= ~bit
+        card.reset()
+
+    def save_card_states(self):
+        """Returns the identities and permissions of all cards (see restore_card_states)"""
+        card_states = [(card.suit, card.value, card.is_public, card.is_private, card.is_unknown)
+                       for card in self.card_collection]
+        return (self.known_mask, self.public_mask, card_states)
+
+    def restore_card_states(self, saved):
+        """Restores the identities and permissions of all cards returned by save_card_states"""
+        self.known_mask, self.public_mask, card_states = saved
+        for card, (suit, value, is_public, is_private, is_unknown) in zip(self.card_collection, card_states):
+            card.suit = suit
+            card.value = value
+            card.is_public = is_public
+            card.is_private = is_private
+            card.is_unknown = is_unknown
+
+    def mark_private_unknown(self, keep_mask=0):
+        """Makes all private cards unknown, except the cards in keep_mask"""
+        # The private cards are the known cards that are not public
+        to_forget = self.known_mask & ~self.public_mask & ~keep_mask
+        if not to_forget:
+            return
+        for card in self.card_collection:
+            if card.is_private and card_bit(card.suit, card.value) & to_forget:
+                self.mark_unknown(card)
 
 
-    def new_trick(self, main_attacker):
-        """We initialize a new trick with main_attacker as starting player"""
-        # We search for the main attacker in all players
+    def seating_from(self, main_attacker):
+        """Returns all players in order of seating starting from main_attacker"""
+        idx = self.name_to_idx.get(main_attacker)
+        if idx is None:
+            raise ValueError(f'Player name {main_attacker} not known')
         people = len(self.players)
-        for idx, player in enumerate(self.players):
-            if player.name == main_attacker:
-                break
-        else:
-            raise 'Player name not known error'
+        return [self.players[i%people] for i in range(idx, idx+people)]
 
+    def new_trick(self, main_attacker):
+        """We initialize a new trick with main_attacker as starting player"""
         # We initialize the players starting from the main attacker
         # A person is still in the game whenever his hand is not empty or if
         # he can draw card.
-        self.attackers = [person for i in range(idx, idx+people)
-                            if (len((person := self.players[i%people]).hand) > 0 or
-                                len(self.deck) > 0)]
+        self.attackers = [person for person in self.seating_from(main_attacker)
+                            if len(person.hand) > 0 or len(self.deck) > 0]
 
         # Check if the game has ended
         if len(self.attackers) == 0:
@@ -144,12 +275,49 @@ class GameTree:
 
         # The action to perform
         self.current_action = 'Attack'
-        # Succesfully defended cards as (attack, defend) pairs
-        self.pairs_finished = []
-        self.cards_to_defend = []
+        # The cards on the table are stored by their index in the card collection.
+        # Succesfully defended cards as (attack, defend) pairs, in two parallel arrays
+        self.pairs_attack = array('b')
+        self.pairs_defend = array('b')
+        self.cards_to_defend_idx = array('b')
+        # The values of all cards on the table as 9-bit mask
+        self.values_on_table = 0
 
 
     def allowed_plays(self):
+        """Returns the allowed actions, cached by the position of the game"""
+        # The key must contain everything find_allowed_plays depends on (and
+        # nothing more), the cards in the hand are in order (-1 for unknown cards).
+        action = self.current_action
+        hand = tuple(-1 if c.is_unknown else c.suit*9 + c.value for c in self.player_to_play.hand)
+        # The identities of unknown cards depend on which cards are public
+        public_mask = self.public_mask if -1 in hand else None
+        if action == 'Attack':
+            key = (action, hand, public_mask, len(self.pairs_attack) > 0 and self.values_on_table,
+                   len(self.defender.hand) > 0)
+        elif action == 'Defend':
+            to_defend = self.card_collection[self.cards_to_defend_idx[0]]
+            if len(self.pairs_attack) == 0:
+                # Reflecting is possible
+                max_new_piles = len(self.attackers[1 % len(self.attackers)].hand) - len(self.cards_to_defend_idx)
+                reflect = (max_new_piles, tuple(self.reflected_trumps))
+            else:
+                reflect = None
+            key = (action, hand, public_mask, to_defend.suit, to_defend.value, to_defend.trump_suit, reflect)
+        else:
+            key = (action, hand, public_mask, self.values_on_table,
+                   len(self.defender.hand) - len(self.cards_to_defend_idx))
+
+        poss_actions = ALLOWED_PLAYS_CACHE.get(key)
+        if poss_actions is None:
+            poss_actions = tuple(self.find_allowed_plays())
+            if len(ALLOWED_PLAYS_CACHE) >= ALLOWED_PLAYS_CACHE_SIZE:
+                ALLOWED_PLAYS_CACHE.clear()
+            ALLOWED_PLAYS_CACHE[key] = poss_actions
+        return poss_actions
+
+    def find_allowed_plays(self):
+        """Returns a list of all allowed actions"""
         # We enumerate the possible actions of
         player = self.player_to_play
         # who will perform
@@ -161,88 +329,99 @@ class GameTree:
             attacker = self.attackers[self.current_attacker]
             assert attacker == player
 
-            # List the possible plays of the player
-            poss_plays = player.possible_card_plays(self.get_non_public_cards())
-
-            if len(self.pairs_finished) > 0:
+            if len(self.pairs_attack) > 0:
                 # There is a pair on the table thus you can pass on attacking
                 poss_actions.append(('PassAttack', None))
-                # If you do not pass, you must play cards with the same
-                # value as those that lie on the table.
-                values_on_table = {card.value for pair in self.pairs_finished for card in pair}
-                poss_plays = {c for c in poss_plays if c[1] in values_on_table}
 
             # Check if you are allowed to make another pile
             if len(self.defender.hand) > 0:
+                # List the possible plays of the player
+                poss_plays = player.possible_card_plays(self.get_non_public_cards())
+                if len(self.pairs_attack) > 0:
+                    # If you do not pass, you must play cards with the same
+                    # value as those that lie on the table (a single AND).
+                    poss_plays &= EXPAND_VALUES[self.values_on_table]
                 # Iterate through the cards you can play
-                for suit, value in poss_plays:
+                for suit, value in iter_cards(poss_plays):
                     poss_actions.append(('Attack', (suit, value)))
 
             # if self.print_info:
             #     print(f"Person {player} attacks with one of [{' '.join('♣♠♥♦'[i] + '6789*JQKA'[j] for i, j in sorted(poss_plays))}]")
         elif action == 'Defend':
             # We need to defend the first card from the single ones
-            to_defend = self.cards_to_defend[0]
+            to_defend = self.card_collection[self.cards_to_defend_idx[0]]
+
+            # The cards (as bitboards) that can defend or reflect the to_defend card
+            trump = 4 if to_defend.trump_suit is None else to_defend.trump_suit
+            defend_mask = DEFEND_MASKS[trump][to_defend.suit*9 + to_defend.value]
+            reflect_mask = 0
+            reflect_trump_mask = 0
+            # Only if there are no finished pairs you can reflect
+            if len(self.pairs_attack) == 0:
+                # Check if you are allowed to make another pile with reflecting
+                # The hypothetical new defender becomes
+                new_defender = self.attackers[1 % len(self.attackers)]
+                # The new defender must be able to defend all cards (if he wants)
+                # with the amount of cards in his hand.
+                max_new_piles = len(new_defender.hand) - len(self.cards_to_defend_idx)
+                # If we reflect by playing the card we create another pile,
+                # you can reflect with any card of the same value
+                if max_new_piles >= 1:
+                    reflect_mask = EXPAND_VALUES[1 << to_defend.value]
+                # If, however we reflect by showing a trump we
+                # do not have to create another pile
+                if max_new_piles >= 0 and trump != 4:
+                    # Check if we already reflected with this trump this trick
+                    if (trump, to_defend.value) not in self.reflected_trumps:
+                        reflect_trump_mask = card_bit(trump, to_defend.value)
 
             # We iterate through each card in the hand to see if we can use
             # it to defend the to_defend card.
-            play_options = defaultdict(int)
+            # The accumulated weight of each (kind of action, card index), the
+            # kinds are Defend, Reflect and ReflectTrump (in that order).
+            weights = [0.] * (3*36)
+            # The cards (as bitboards) that received weight for each kind
+            played = [0, 0, 0]
+            # An unknown card in the hand can be any non public card that is
+            # not a known card in the hand, this is the same for all unknown cards.
+            known_in_hand = 0
+            for card in player.hand:
+                if not card.is_unknown:
+                    known_in_hand |= card_bit(card.suit, card.value)
+            unknown_identities = self.get_non_public_cards() & ~known_in_hand
             for card in player.hand:
                 # Find the possible identities of this card
                 if card.is_unknown:
-                    identities = self.get_non_public_cards() - \
-                            {(c.suit, c.value) for c in player.hand if not c.is_unknown}
+                    identities = unknown_identities
                 else:
-                    identities = {(card.suit, card.value)}
-
-                # Check if we can play that identity
-                reflect = []
-                defend = []
-                for suit, value in identities:
-                    ### Reflecting
-                    # Only if there are no finished pairs you can reflect
-                    if len(self.pairs_finished) == 0:
-                        # Check if you are allowed to make another pile with reflecting
-                        # The hypothetical new defender becomes
-                        new_defender = self.attackers[1 % len(self.attackers)]
-                        # The new defender must be able to defend all cards (if he wants)
-                        # with the amount of cards in his hand.
-                        max_new_piles = len(new_defender.hand) - len(self.cards_to_defend)
-                        # If we reflect by playing the card we create another pile
-                        if max_new_piles >= 1:
-                            # Check if you can reflect the to_defend card with this card
-                            if value == to_defend.value:
-                                reflect.append(('Reflect', (suit, value)))
-                        # If, however we reflect by showing a trump we
-                        # do not have to create another pile
-                        if max_new_piles >= 0:
-                            # Check if you can reflect the to_defend card by showing your trump
-                            if value == to_defend.value and suit == to_defend.trump_suit:
-                                # Check if we already reflected with this trump this trick
-                                if (suit, value) not in self.reflected_trumps:
-                                    reflect.append(('ReflectTrump', (suit, value)))
-
-                    ### Defending
-                    # Check if you can defend the to_defend card with this card
-                    if suit == to_defend.trump_suit and not to_defend.is_trump():
-                        # You can always play a trump on a non-trump card to win
-                        defend.append(('Defend', (suit, value)))
-                    if suit == to_defend.suit:
-                        # If the cards are of the same suit, you need to play a higher card
-                        if value > to_defend.value:
-                            defend.append(('Defend', (suit, value)))
+                    identities = card_bit(card.suit, card.value)
+
+                # Check which identities we can play
+                defend = identities & defend_mask
+                reflect = identities & reflect_mask
+                reflect_trump = identities & reflect_trump_mask
 
                 # Add all the options together to the possible actions.
                 # Weights are added to prevent from overreflecting and too good cards
                 # from another perspetive
-                for action in defend:
-                    play_options[action] += 1 / len(defend)
-                for action in reflect:
-                    play_options[action] += 1 / len(reflect)
+                if defend:
+                    weight = 1 / popcount(defend)
+                    for idx in iter_bits(defend):
+                        weights[idx] += weight
+                    played[0] |= defend
+                if reflect or reflect_trump:
+                    weight = 1 / (popcount(reflect) + popcount(reflect_trump))
+                    for idx in iter_bits(reflect):
+                        weights[36 + idx] += weight
+                    for idx in iter_bits(reflect_trump):
+                        weights[72 + idx] += weight
+                    played[1] |= reflect
+                    played[2] |= reflect_trump
 
             # Restructure the playing options to normal actions formats
-            for key, weight in play_options.items():
-                poss_actions.append(key + (weight,))
+            for kind, name in enumerate(('Defend', 'Reflect', 'ReflectTrump')):
+                for idx in iter_bits(played[kind]):
+                    poss_actions.append((name, divmod(idx, 9), weights[kind*36 + idx]))
 
             # As the defender you can always take up the cards
             poss_actions.append(('Take', None, 1/2))
@@ -255,25 +434,41 @@ class GameTree:
             poss_throws = player.possible_card_plays(self.get_non_public_cards())
 
             # You can only throw cards with the same value as those on the table
-            values_on_table = {card.value for pair in self.pairs_finished for card in pair}
-            values_on_table.update({card.value for card in self.cards_to_defend})
-            poss_throws = {c for c in poss_throws if c[1] in values_on_table}
+            poss_throws = list(iter_cards(poss_throws & EXPAND_VALUES[self.values_on_table]))
             # The amount of cards you can throw equals the number of cards in the hand
             # of the defender (originally) minus the amount of piles.
             # Hence, the number of current cards in the hand minus the amount of cards to defend.
-            available_throws = len(self.defender.hand) - len(self.cards_to_defend)
+            available_throws = len(self.defender.hand) - len(self.cards_to_defend_idx)
             # If 0 cards are thrown
             poss_actions.append(('ThrowCards', (None,)))
             # If more than 0 cards are thrown
             max_throws = min(available_throws, len(poss_throws), len(player.hand))
             if max_throws > 0:
                 fallback_identities = self.get_non_public_cards()
-            for throw in range(1, max_throws + 1):
+                # The throws that are not a known card in the hand must be played
+                # with an unknown card, as a mask over the indices of poss_throws.
+                known_in_hand = 0
+                unknown_in_hand = 0
+                for card in player.hand:
+                    if card.is_unknown:
+                        unknown_in_hand += 1
+                    else:
+                        known_in_hand |= card_bit(card.suit, card.value)
+                needs_unknown = 0
+                throw_bits = [card_bit(suit, value) for suit, value in poss_throws]
+                for idx, bit in enumerate(throw_bits):
+                    if not bit & known_in_hand:
+                        needs_unknown |= 1 << idx
+
                 # Any combination of throws are possible
-                for option in combinations(poss_throws, r=throw):
-                    if player.can_throw(fallback_identities, list(option)):
-                        poss_actions.append(('ThrowCards', option))
-                        # print(player, 'THROWING...', tmp)
+                for subset, indices in throw_subsets(len(poss_throws), max_throws):
+                    # Quick reject: not enough unknown cards in the hand
+                    if popcount(subset & needs_unknown) <= unknown_in_hand:
+                        cards_mask = 0
+                        for idx in indices:
+                            cards_mask |= throw_bits[idx]
+                        if player.can_throw(fallback_identities, cards_mask):
+                            poss_actions.append(('ThrowCards', tuple(poss_throws[idx] for idx in indices)))
             # if self.print_info:
             #     print(f"Person {player} can throw")
         else:
@@ -286,114 +481,191 @@ class GameTree:
         return poss_actions
 
     def get_id(self):
-        return hash(tuple(self.history))
+        return self.zobrist
 
     def execute_action(self, action):
+        """Executes the action and adds it to the history of the game"""
         # Add action to history
         self.history.append(action)
-
-        if action[0] == 'Attack':
-            suit, value = action[1]
-            # We need to go from a (suit, value) pair to the card
-            card_played = self.player_to_play.discard_card(self, suit, value)
-            # Set other values
-            self.last_played_attacker = self.player_to_play
-            self.player_to_play = self.defender
-            self.current_action = 'Defend'
-            self.cards_to_defend.append(card_played)
-        elif action[0] == 'Defend':
-            card_defended = self.cards_to_defend.pop(0)
-            suit, value = action[1]
-            ### We defend the card_defended card with (suit, value)
-            card_played = self.player_to_play.discard_card(self, suit, value)
-            self.pairs_finished += [(card_defended, card_played)]
-            if len(self.cards_to_defend) == 0:
-                # There are no more cards left to defend, switch to attacking again
-                self.player_to_play = self.attackers[self.current_attacker]
-                self.current_action = 'Attack'
-        elif action[0] == 'Take':
-            self.current_action = 'ThrowCards'
-            self.player_to_play = self.attackers[self.current_attacker]
-            self.attacker_to_start_throwing = self.current_attacker
+        # Update the hash of the history with the action
+        keys = ZOBRIST_KEYS[ZOBRIST_ACTIONS[action[0]]]
+        player_idx = self.name_to_idx[self.player_to_play.name]
+        zobrist = self.zobrist
+        if action[1] is None or action[1][0] is None:
+            # Take, PassAttack or throwing no cards
+            zobrist ^= keys[36][player_idx]
         elif action[0] == 'ThrowCards':
-            if action[1][0] is not None:
-                # We must throw some cards
-                cards_to_throw = action[1]
-                for suit, value in cards_to_throw:
-                    # NOTE: is discarding in a certain order necessary??
-                    card_played = self.player_to_play.discard_card(self, suit, value)
-                    self.cards_to_defend.append(card_played)
-            # Increase attacker and player to play
-            self.current_attacker = (self.current_attacker + 1) % len(self.attackers)
+            for suit, value in action[1]:
+                zobrist ^= keys[suit*9 + value][player_idx]
+        else:
+            zobrist ^= keys[action[1][0]*9 + action[1][1]][player_idx]
+        self.zobrist = (zobrist * ZOBRIST_MULTIPLIER) & ZOBRIST_MASK
+
+        self.apply_action(action)
+
+    def apply_attack(self, action):
+        """The player to play attacks with the (suit, value) card"""
+        suit, value = action[1]
+        # We need to go from a (suit, value) pair to the card
+        card_played = self.player_to_play.discard_card(self, suit, value)
+        # Set other values
+        self.last_played_attacker = self.player_to_play
+        self.player_to_play = self.defender
+        self.current_action = 'Defend'
+        self.cards_to_defend_idx.append(card_played.idx)
+        self.values_on_table |= 1 << value
+
+    def apply_defend(self, action):
+        """The defender defends the first card to defend with the (suit, value) card"""
+        card_defended_idx = self.cards_to_defend_idx.pop(0)
+        suit, value = action[1]
+        ### We defend the card_defended card with (suit, value)
+        card_played = self.player_to_play.discard_card(self, suit, value)
+        self.pairs_attack.append(card_defended_idx)
+        self.pairs_defend.append(card_played.idx)
+        self.values_on_table |= 1 << value
+        if len(self.cards_to_defend_idx) == 0:
+            # There are no more cards left to defend, switch to attacking again
             self.player_to_play = self.attackers[self.current_attacker]
+            self.current_action = 'Attack'
+
+    def apply_take(self, action):
+        """The defender takes the cards, the attackers may throw cards"""
+        self.current_action = 'ThrowCards'
+        self.player_to_play = self.attackers[self.current_attacker]
+        self.attacker_to_start_throwing = self.current_attacker
+
+    def apply_throw_cards(self, action):
+        """The player to play throws the (suit, value) cards (or none)"""
+        if action[1][0] is not None:
+            # We must throw some cards
+            self.throw_cards(action[1])
+        # Increase attacker and player to play
+        self.current_attacker = (self.current_attacker + 1) % len(self.attackers)
+        self.player_to_play = self.attackers[self.current_attacker]
+
+        # Check if everybody got the chance to throw their cards
+        if self.player_to_play == self.attackers[self.attacker_to_start_throwing]:
+            self.end_taken_trick()
+
+    def apply_pass_attack(self, action):
+        """The player to play passes on attacking"""
+        # The person passed on attacking, the next attacker may play
+        self.current_attacker = (self.current_attacker + 1) % len(self.attackers)
+        self.player_to_play = self.attackers[self.current_attacker]
+
+        # Check if we have an entire round of people that do not want to attack
+        if self.player_to_play == self.last_played_attacker:
+            self.end_defended_trick()
+
+    def apply_reflect(self, action):
+        """The defender reflects with the (suit, value) card"""
+        card_played = self.defender.discard_card(self, action[1][0], action[1][1])
+        # The new defender sits left of the current defender, the main attacker
+        # stays the same and the current cards need to be defended
+        self.last_played_attacker = self.player_to_play
+        self.pass_defence()
+        self.cards_to_defend_idx.append(card_played.idx)
+        self.values_on_table |= 1 << card_played.value
+        self.current_action = 'Defend'
+        self.player_to_play = self.defender
+
+    def apply_reflect_trump(self, action):
+        """The defender reflects by showing the (suit, value) trump"""
+        # By only having to show the trump you can reflect the cards
+        suit, value = action[1]
+        # You must be the defender to do this
+        assert self.player_to_play == self.defender
+        # Everyone now knows you have that trump card but you do not lose the card
+        self.player_to_play.discard_card(self, suit, value, remove=False)
+        # This card loses its ability to reflect for the rest of this trick
+        self.reflected_trumps.append((suit, value))
+        # The new defender sits left of the current defender,
+        # the main attacker stays the same
+        # and the current cards need to be defended
+        self.last_played_attacker = self.player_to_play
+        self.pass_defence()
+        self.current_action = 'Defend'
+        self.player_to_play = self.defender
+
+    # The method that executes each type of action
+    APPLY_ACTIONS = {
+        'Attack': apply_attack,
+        'Defend': apply_defend,
+        'Take': apply_take,
+        'ThrowCards': apply_throw_cards,
+        'PassAttack': apply_pass_attack,
+        'Reflect': apply_reflect,
+        'ReflectTrump': apply_reflect_trump,
+    }
+
+    def apply_action(self, action):
+        """Executes the action without adding it to the history of the game"""
+        apply = self.APPLY_ACTIONS.get(action[0])
+        if apply is None:
+            raise NotImplementedError('Action to execute not implemented.')
+        apply(self, action)
+
+
+    def pass_defence(self):
+        """The defender reflected, the player to his left becomes the defender"""
+        # The new defender takes the place of the old defender in the attackers
+        # (this is done in place, without building new lists)
+        idx = 1 % len(self.attackers)
+        new_defender = self.attackers[idx]
+        self.attackers[idx] = self.defender
+        self.defender = new_defender
+        self.draw_order = self.attackers + [self.defender]
+        # The current attacker
+        self.attackers.append(self.attackers.pop(0))
+
+    def throw_cards(self, cards_to_throw):
+        """The player to play throws the (suit, value) cards on the table"""
+        for suit, value in cards_to_throw:
+            # NOTE: is discarding in a certain order necessary??
+            card_played = self.player_to_play.discard_card(self, suit, value)
+            self.cards_to_defend_idx.append(card_played.idx)
+            self.values_on_table |= 1 << value
+
+    def end_taken_trick(self):
+        """The defender takes all cards on the table, a new trick starts"""
+        cards = self.card_collection
+        for attack_idx, defend_idx in zip(self.pairs_attack, self.pairs_defend):
+            self.defender.hand += [cards[attack_idx], cards[defend_idx]]
+        self.defender.hand += [cards[idx] for idx in self.cards_to_defend_idx]
+        for p in self.draw_order:
+            self.deck = p.fill_hand(self.deck)
+        # The defender takes the cards, the new main attacker is the one
+        # to the left of the defender (or the second attacker)
+        self.new_trick(self.attackers[1 % len(self.attackers)].name)
+
+    def end_defended_trick(self):
+        """The defender defended successfully, a new trick starts"""
+        # Let everybody draw cards
+        for p in self.draw_order:
+            self.deck = p.fill_hand(self.deck)
 
-            # Check if everybody got the chance to throw their cards
-            if self.player_to_play == self.attackers[self.attacker_to_start_throwing]:
-                cards_on_table = [card for pair in self.pairs_finished for card in pair]
-                cards_on_table += self.cards_to_defend
-                self.defender.hand += cards_on_table
-                for p in self.draw_order:
-                    self.deck = p.fill_hand(self.deck)
-                # The defender takes the cards, the new main attacker is the one
-                # to the left of the defender (or the second attacker)
-                self.new_trick(self.attackers[1 % len(self.attackers)].name)
-        elif action[0] == 'PassAttack':
-            # The person passed on attacking, the next attacker may play
-            self.current_attacker = (self.current_attacker + 1) % len(self.attackers)
-            self.player_to_play = self.attackers[self.current_attacker]
+        # Perform checks and prints
+        assert len(self.cards_to_defend_idx) == 0  # Cards still need to be defended
+        if self.print_info:
+            cards = self.card_collection
+            print(f'The card pairs [{"".join(f"({str(cards[a])[1:]}, {str(cards[d])[1:]})" for a, d in zip(self.pairs_attack, self.pairs_defend))}] are removed from the game')
+        # Initialize a new trick with the defender as main attacker
+        self.new_trick(self.defender.name)
 
-            # Check if we have an entire round of people that do not want to attack
-            if self.player_to_play == self.last_played_attacker:
-                # The defender defended successfully
-                # Let everybody draw cards
-                for p in self.draw_order:
-                    self.deck = p.fill_hand(self.deck)
-
-                # Perform checks and prints
-                assert self.cards_to_defend == []  # Cards still need to be defended
-                if self.print_info:
-                    print(f'The card pairs [{"".join(f"({str(p[0])[1:]}, {str(p[1])[1:]})" for p in self.pairs_finished)}] are removed from the game')
-                # Initialize a new trick with the defender as main attacker
-                self.new_trick(self.defender.name)
-        elif action[0] == 'Reflect':
-            card_played = self.defender.discard_card(self, action[1][0], action[1][1])
-            # The new defender sits left of the current defender, the main attacker
-            # stays the same and the current cards need to be defended
-            self.last_played_attacker = self.player_to_play
-            num_old_attackers = len(self.attackers)
-            new_defender = self.attackers.pop(1 % num_old_attackers)
-            self.attackers.insert(1 % num_old_attackers, self.defender)
-            self.defender = new_defender
-            self.draw_order = self.attackers + [self.defender]
-            # The current attacker
-            self.attackers = self.attackers[1:] + [self.attackers[0]]
-            self.cards_to_defend.append(card_played)
-            self.current_action = 'Defend'
-            self.player_to_play = self.defender
-        elif action[0] == 'ReflectTrump':
-            # By only having to show the trump you can reflect the cards
-            suit, value = action[1]
-            # You must be the defender to do this
-            assert self.player_to_play == self.defender
-            # Everyone now knows you have that trump card but you do not lose the card
-            self.player_to_play.discard_card(self, suit, value, remove=False)
-            # This card loses its ability to reflect for the rest of this trick
-            self.reflected_trumps.append((suit, value))
-            # The new defender sits left of the current defender,
-            # the main attacker stays the same
-            # and the current cards need to be defended
-            self.last_played_attacker = self.player_to_play
-            num_old_attackers = len(self.attackers)
-            new_defender = self.attackers.pop(1 % num_old_attackers)
-            self.attackers.insert(1 % num_old_attackers, self.defender)
-            self.defender = new_defender
-            self.draw_order = self.attackers + [self.defender]
-            # The current attacker
-            self.attackers = self.attackers[1:] + [self.attackers[0]]
-            self.current_action = 'Defend'
-            self.player_to_play = self.defender
-        else:
-            raise NotImplementedError('Action to execute not implemented.')
+
+    def play_randomly(self):
+        """Plays random allowed actions until the game ends, returns the loser
+
+        The actions are not added to the history, thus the game state should
+        be thrown away afterwards (as is done in the MCTS simulations).
+        """
+        apply_actions = self.APPLY_ACTIONS
+        while not self.is_end_state:
+            # The positions of random playouts rarely repeat, skip the cache
+            action = choose_random_action(self.find_allowed_plays())
+            apply_actions[action[0]](self, action)
+        return self.loser
 
 
     def make_deepcopy(self):
@@ -404,8 +676,7 @@ class GameTree:
         # new.print_info = False
         # return new
         ### Faster code
-        new = GameTree(0, 0, 0, False)
-        players = [p.make_copy() for p in self.players]
+        new = type(self)(0, 0, 0, False)
 
         ### We copy all the players in all the places
         new.players = []
@@ -414,6 +685,7 @@ class GameTree:
             copy_p = p.make_copy()
             player_ids[id(p)] = copy_p
             new.players.append(copy_p)
+        new.name_to_idx = self.name_to_idx  # the names are not changed
 
         new.attackers = [player_ids[id(p)] for p in self.attackers]
         new.draw_order = [player_ids[id(p)] for p in self.draw_order]
@@ -426,27 +698,31 @@ class GameTree:
         new.is_end_state = self.is_end_state
         new.computer_shuffle = self.computer_shuffle
         new.all_cards = self.all_cards
+        new.known_mask = self.known_mask
+        new.public_mask = self.public_mask
         new.current_action = self.current_action
         new.current_attacker = self.current_attacker
         new.attacker_to_start_throwing = self.attacker_to_start_throwing
         new.reflected_trumps = self.reflected_trumps.copy()  # (suit, value) pairs
+        new.values_on_table = self.values_on_table
         new.history = self.history.copy()
+        new.zobrist = self.zobrist
         new.print_info = False
 
         ### And now we copy all the cards changing each card in all places
-        new.card_collection = []
-        card_ids = {}  # dict of all the cards with their copy
-        for card in self.card_collection:
-            # Change card on all different places
-            copy_card = card.make_copy()
-            card_ids[id(card)] = copy_card
-            new.card_collection.append(copy_card)
+        # Every card knows its index in the card collection, thus the copy
+        # of a card can be found without looking it up.
+        new.card_collection = cards = [card.make_copy() for card in self.card_collection]
 
         for player_idx, p in enumerate(self.players):
-            new.players[player_idx].hand = [card_ids[id(c)] for c in p.hand]
-        new.deck = [card_ids[id(c)] for c in self.deck]
-        new.cards_to_defend = [card_ids[id(c)] for c in self.cards_to_defend]
-        new.pairs_finished = [(card_ids[id(p[0])], card_ids[id(p[1])]) for p in self.pairs_finished]
+            new.players[player_idx].hand = [cards[c.idx] for c in p.hand]
+        # Cards are only drawn from the top of the deck, thus the deck is always
+        # the end of the card collection and it can be copied as one slice.
+        new.deck = cards[len(cards) - len(self.deck):]
+        # The cards on the table are indices, thus they are copied as they are
+        new.cards_to_defend_idx = self.cards_to_defend_idx[:]
+        new.pairs_attack = self.pairs_attack[:]
+        new.pairs_defend = self.pairs_defend[:]
         return new
 
 
@@ -471,8 +747,41 @@ class GameTree:
         self.execute_action(action)
 
 
+class GameTree2P(GameTree):
+    """The game tree specialized for two players
+
+    With two players there is only one attacker, thus there is no rotation
+    through the attackers: passing or throwing cards always ends the trick.
+    """
+    __slots__ = ()
+
+    def seating_from(self, main_attacker):
+        """Returns both players starting from main_attacker"""
+        first, second = self.players
+        if first.name == main_attacker:
+            return [first, second]
+        elif second.name == main_attacker:
+            return [second, first]
+        raise ValueError(f'Player name {main_attacker} not known')
+
+    def apply_pass_attack(self, action):
+        """The only attacker passed, the defender defended successfully"""
+        self.end_defended_trick()
+
+    def apply_throw_cards(self, action):
+        """The only attacker throws the (suit, value) cards (or none)"""
+        if action[1][0] is not None:
+            # We must throw some cards
+            self.throw_cards(action[1])
+        # The only attacker got the chance to throw cards
+        self.end_taken_trick()
+
+    APPLY_ACTIONS = {**GameTree.APPLY_ACTIONS,
+                     'PassAttack': apply_pass_attack,
+                     'ThrowCards': apply_throw_cards}
+
+
 if __name__ == '__main__':
-    import random
     random.seed(2)
     # Note the main attacker should be specified
 
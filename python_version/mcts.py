@@ -1,50 +1,49 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from math import log, sqrt
+import random
 
 from tools import choose_random_action
 
 
-class MCNodeEnd:
-    """Game states reached from playing an action as the perspective player"""
-    W = 0  # Score
-    N = 0  # Number of traversals
-    is_explored = False
-
-    def get_N_W(self):
-        return (self.N, self.W)
-
 class MCNodeChoose:
     """Game states from which the perspective players can choose an action"""
-    W = 0  # Score
-    N = 0  # Number of traversals
+    __slots__ = ('W', 'N', 'game_state', 'is_end_state', 'is_explored',
+                 'actions', 'edge_W', 'edge_N', 'unexplored')
 
     def __init__(self, game_state):
+        self.W = 0  # Score
+        self.N = 0  # Number of traversals
         self.game_state = game_state
         self.is_end_state = game_state.is_end_state
         self.is_explored = False
-        # The children are of the form {
-        #   last_action_played: MCNodeEnd
-        # }
-        self.children = {}
+        # The allowed actions with the statistics of playing them as parallel
+        # lists, the game states after an action are not stored (the other
+        # players still have to play), thus the statistics are kept on the edge.
+        self.actions = ()
+        self.edge_W = []  # Score
+        self.edge_N = []  # Number of traversals
+        # The indices of the actions that are not yet explored,
+        # the last one is explored first
+        self.unexplored = []
 
     def uct_select(self, expl_const):
-        # There are some children as this node is explored and non-terminal
-        kids = []
-        for action_played, mcnodeend in self.children.items():
-            N, W = mcnodeend.get_N_W()
-            if N > 0:  # If the child is traversed
-                kids.append((action_played, N, W))
-
-        assert self.N > 0  # Check if node is traversed
-        assert len(kids) > 0  # At least one of the children must be traversed
+        """Returns the index of the action with the highest UCT score
 
+        The node must be traversed and at least one of the actions too.
+        """
+        # There are some actions as this node is explored and non-terminal
         const = expl_const * sqrt(log(self.N))
-        def uct(args):
-            _, N, W = args
-            return W / N + const * N**(-.5)
 
-        # Choose best kid
-        best = max(kids, key=uct)
-        return (best[0], self.children[best[0]])
+        # Choose the best action in a single pass
+        best_score, best_idx = -1., None
+        for idx, N in enumerate(self.edge_N):
+            if N > 0:  # If the action is traversed
+                score = self.edge_W[idx] / N + const / sqrt(N)
+                if score > best_score:
+                    best_score, best_idx = score, idx
+
+        return best_idx
 
 
 class MCTreeFPV:
@@ -64,17 +63,16 @@ class MCTreeFPV:
         mctsnode = self.current_traversals[game_id]
 
         # Choose the action with the highest score
-        kids = []
         best, action_to_play = -1, None
-        for action, node in mctsnode.children.items():
-            if node.N > 0:
+        for action, W, N in zip(mctsnode.actions, mctsnode.edge_W, mctsnode.edge_N):
+            if N > 0:
                 if self.scoring == 'Winning percentage':
-                    score = node.W / node.N  # winning percentage
+                    score = W / N  # winning percentage
                 elif self.scoring == 'Visit count':
-                    score = node.N  # visit count
+                    score = N  # visit count
                 else:
                     raise ValueError('Scoring type not known')
-                # print(action, node.W, node.N)
+                # print(action, W, N)
                 if score > best:
                     best = score
                     action_to_play = action
@@ -100,58 +98,65 @@ class MCTreeFPV:
             # not change over time
             self.player_name = game_state.player_to_play.name
         # Only calls from the perspective player can be made in this tree
-        # otherwise the Choose and End nodes will not be configured correctly.
+        # otherwise the nodes will not be configured correctly.
         # Although this would then still return the correct answer, (making a
         # new node) this is a simple check to observe what happens.
         assert self.player_name == game_state.player_to_play.name
 
         # Perform the rollouts/traversals
+        # (the steps are bound once, not looked up on every rollout)
+        select, expand, simulate, backpropagate = self.select, self.expand, self.simulate, self.backpropagate
         for rollout in range(rollouts):
-            print(f'Doing rollout {rollout} for {self.player_name}', end='\r')
+            # Only show the progress now and then, printing is slow compared to a rollout
+            if rollout % 100 == 0:
+                print(f'Doing rollout {rollout} for {self.player_name}', end='\r')
             # Do the (IS)MCTS
-            path, leaf_node = self.select()
-            self.expand(leaf_node)
-            name_of_loser = self.simulate(leaf_node)
-            self.backpropagate(path, name_of_loser)
+            path, edges, leaf_node = select()
+            expand(leaf_node)
+            name_of_loser = simulate(leaf_node)
+            backpropagate(path, edges, name_of_loser)
         print(' '*50, end='\r')
 
     def select(self):
         """Select a leaf node from the tree"""
         # Traverse the tree as long as possible
         mctsnode = self.mctsnode
-        # Remember the traversed path
+        # Remember the traversed path, the nodes and the (node, action index)
+        # of the actions played by the perspective player
         path = []
+        edges = []
         while True:
             path.append(mctsnode)
             # Check if we stop traversing
             if not mctsnode.is_explored:
                 # This game never got expanded, end
-                return path, mctsnode
+                return path, edges, mctsnode
 
             if mctsnode.is_end_state:
                 # An end state, thus this is already a leaf
-                return path, mctsnode
+                return path, edges, mctsnode
 
-            # Otherwise, we go to a unexplored child
-            for action, node in mctsnode.children.items():
-                if not node.is_explored:
-                    node.is_explored = True
-                    break
+            # Otherwise, we go to a unexplored action
+            if mctsnode.unexplored:
+                idx = mctsnode.unexplored.pop()
             else:
-                # If all children are explored, we select a child according
+                # If all actions are explored, we select one according
                 # to the UCT scoring.
-                action, node = mctsnode.uct_select(self.expl_const)
-            # node is a MCNodeEnd, of which the N and W must also be increased
+                idx = mctsnode.uct_select(self.expl_const)
+            action = mctsnode.actions[idx]
+            # The N and W of the action must also be increased
             # for calculating the UCT correctly
-            path.append(node)
+            edges.append((mctsnode, idx))
 
             # Do random plays until player_to_play == self.player_name
             # i.e. the perspective player may play again
             game = mctsnode.game_state.make_deepcopy()
             # Perform the action of the perspective player
             game.execute_action(action)
-            # Perform random allowed actions
-            while not game.is_end_state and game.player_to_play.name != self.player_name:
+            # Perform random allowed actions, the perspective player is found
+            # once (the players keep their seat) and compared by identity
+            perspective_player = game.players[game.name_to_idx[self.player_name]]
+            while not game.is_end_state and game.player_to_play is not perspective_player:
                 allowed = game.allowed_plays()
                 action = choose_random_action(allowed)
                 game.execute_action(action)
@@ -165,7 +170,7 @@ class MCTreeFPV:
                 # Not a known game state, make new node and return it
                 leaf_node = MCNodeChoose(game)
                 path.append(leaf_node)
-                return path, leaf_node
+                return path, edges, leaf_node
 
     def expand(self, leaf_node):
         """Expand the leaf node from the tree, i.e. simulate all possible actions"""
@@ -178,8 +183,12 @@ class MCTreeFPV:
         self.current_traversals[game.get_id()] = leaf_node
         # Check which actions we're allowed to do
         allowed = game.allowed_plays()
-        # Initialize the children of the leaf node
-        leaf_node.children = {action: MCNodeEnd() for action in allowed}
+        # Initialize the actions of the leaf node
+        leaf_node.actions = allowed
+        leaf_node.edge_W = [0] * len(allowed)
+        leaf_node.edge_N = [0] * len(allowed)
+        # The actions are explored in the order of the allowed plays
+        leaf_node.unexplored = list(range(len(allowed) - 1, -1, -1))
         leaf_node.is_explored = True
 
     def simulate(self, leaf_node):
@@ -187,88 +196,135 @@ class MCTreeFPV:
         if leaf_node.is_end_state:
             return leaf_node.game_state.loser.name
 
-        # Choose a random action from the children of the leaf node
-        action = choose_random_action(list(leaf_node.children.keys()))
+        # Choose a random action from the actions of the leaf node
+        action = choose_random_action(leaf_node.actions)
         # Execute the action
         game = leaf_node.game_state.make_deepcopy()
         game.execute_action(action)
 
-        # Traverse the tree randomly
-        while not game.is_end_state:
-            # Execute a random allowed action
-            allowed = game.allowed_plays()
-            action = choose_random_action(allowed)
-            game.execute_action(action)
+        # Traverse the tree randomly and return the loser of the game
+        # (the name of since strings are immutable)
+        return game.play_randomly().name
 
-        # Return the loser of the game (the name of since strings are immutable)
-        return game.loser.name
-
-    def backpropagate(self, path, name_of_loser):
+    def backpropagate(self, path, edges, name_of_loser):
         """Increases visit counts in the tree (and winning count, etc)"""
-        for mctsnode in reversed(path):  # bottom up traversal
-            # Increase visit count
-            mctsnode.N += 1
-
-            # Increase reward
-            if name_of_loser != self.player_name:
-                # This person did not lose
+        # All nodes are from the perspective player, thus the reward is
+        # the same for the entire path (the order does not matter).
+        if name_of_loser != self.player_name:
+            # This person did not lose
+            for mctsnode in path:
+                mctsnode.N += 1
                 mctsnode.W += 1
+            for mctsnode, idx in edges:
+                mctsnode.edge_N[idx] += 1
+                mctsnode.edge_W[idx] += 1
+        else:
+            for mctsnode in path:
+                mctsnode.N += 1
+            for mctsnode, idx in edges:
+                mctsnode.edge_N[idx] += 1
 
 
 class MCNode:
     """Game states from which any player can choose an action"""
-    W = 0  # Score
-    N = 0  # Number of traversals
+    __slots__ = ('W', 'N', 'game_state', 'is_end_state', 'player_name', 'is_explored',
+                 'parent', 'idx_in_parent', 'actions', 'children', 'first_unexplored', 'allowed')
 
     def __init__(self, parent=None, game_state=None):
+        self.W = 0  # Score
+        self.N = 0  # Number of traversals
         if game_state is None:
             self.game_state = None
             self.is_end_state = None
+            self.player_name = None
         else:
             self.game_state = game_state
             self.is_end_state = game_state.is_end_state
+            self.player_name = game_state.player_to_play.name
         self.is_explored = False
         self.parent = parent  # MCNode
-        # The children are of the form {
-        #   last_action_played: MCNode
-        # }
-        self.children = {}
+        # The position of this node in the children of the parent
+        self.idx_in_parent = None
+        # The children as parallel lists of the played action and the MCNode
+        self.actions = []
+        self.children = []
+        # All children before this index are explored (explored nodes stay
+        # explored), thus they are not checked again on every traversal.
+        # Not used by ISMCTS, there the allowed children differ per determinization.
+        self.first_unexplored = 0
+        # The allowed plays (without weights) from this node, only stored
+        # when they do not depend on a determinization
+        self.allowed = None
 
     def get_game_state(self):
         """For preventing from finding all unsearched game states"""
         if self.game_state is not None:
             return self.game_state
+        return self.make_game_state()
+
+    def store_game_state(self):
+        """Materializes the game state of this node and keeps it, returns it"""
+        # Stored states cost memory, but the descendants of this node are then
+        # made from a single copy instead of replaying the path from the root.
+        if self.game_state is None:
+            self.game_state = self.make_game_state()
+        return self.game_state
+
+    def forget_game_states(self):
+        """Removes the stored game states of this node and all its descendants"""
+        nodes = [self]
+        while nodes:
+            mctsnode = nodes.pop()
+            mctsnode.game_state = None
+            nodes.extend(mctsnode.children)
+
+    def make_game_state(self):
+        """Returns a new game state of this node (which may be changed)"""
+        if self.game_state is not None:
+            return self.game_state.make_deepcopy()
         # Execute the action contained in the edge above this node
-        # i.e. in the children of parent
-        assert self.parent is not None
-        for action_to_perform, child in self.parent.children.items():
-            if id(child) == id(self):
-                game = self.parent.get_game_state().make_deepcopy()
-                game.execute_action(action_to_perform)
-                self.is_end_state = game.is_end_state
-                return game
-        else:
-            raise BaseException('Unable to find child in the children of its parent')
+        # i.e. in the children of parent (the root has a game state).
+        # The game state of the parent is new, thus only the game state
+        # of the first stored ancestor is copied (once).
+        game = self.parent.make_game_state()
+        game.execute_action(self.parent.actions[self.idx_in_parent])
+        # Remember what is needed from the game state without storing it
+        self.is_end_state = game.is_end_state
+        self.player_name = game.player_to_play.name
+        return game
+
+    def add_child(self, action):
+        """Adds a new child reached by playing action, returns its index"""
+        child = type(self)(parent=self)
+        child.idx_in_parent = len(self.children)
+        self.actions.append(action)
+        self.children.append(child)
+        return child.idx_in_parent
 
     def uct_select(self, expl_const):
+        """Returns the (action, child) with the highest UCT score
+
+        The node must be traversed and at least one of the children too.
+        """
         # There are some children as this node is explored and non-terminal
-        kids = []
-        for action_played, mctsnode in self.children.items():
-            N, W = mctsnode.N, mctsnode.W
+        const = expl_const * sqrt(log(self.N))
+
+        # Choose the best kid in a single pass
+        best_score, best_action, best_node = -1., None, None
+        for action_played, mctsnode in zip(self.actions, self.children):
+            N = mctsnode.N
             if N > 0:  # If the child is traversed
-                kids.append((action_played, N, W))
+                score = mctsnode.W / N + const / sqrt(N)
+                if score > best_score:
+                    best_score, best_action, best_node = score, action_played, mctsnode
 
-        assert self.N > 0  # Check if node is traversed
-        assert len(kids) > 0  # At least one of the children must be traversed
+        return (best_action, best_node)
 
-        const = expl_const * sqrt(log(self.N))
-        def uct(args):
-            _, N, W = args
-            return W / N + const * N**(-.5)
 
-        # Choose best kid
-        best = max(kids, key=uct)
-        return (best[0], self.children[best[0]])
+def rollout_worker(game_state, rollouts, expl_const, seed):
+    """Performs rollouts on a new tree in a worker process, returns the statistics"""
+    random.seed(seed)
+    return MCTree().do_rollouts(game_state, rollouts, expl_const, show_progress=False)
 
 
 class MCTree:
@@ -280,33 +336,54 @@ class MCTree:
         self.player_name = None
 
 
-    def do_rollouts(self, game_state, rollouts=1000, expl_const=.7):
+    def do_rollouts(self, game_state, rollouts=1000, expl_const=.7, workers=1, show_progress=True):
         """We traverse this tree where each node is the state from which
         the player (the perspective player) can choose an action.
         """
+        if workers > 1:
+            return self.do_parallel_rollouts(game_state, rollouts, expl_const, workers)
         self.expl_const = expl_const
         # Also, because of imperfect information, the search tree cannot be reused
         # Create a new node
         self.mctsnode = MCNode(game_state=game_state)
 
         # Perform the rollouts/traversals
+        # (the steps are bound once, not looked up on every rollout)
+        select, expand, simulate, backpropagate = self.select, self.expand, self.simulate, self.backpropagate
         for rollout in range(rollouts):
-            print(f'Doing rollout {rollout} for {game_state.player_to_play.name}', end='\r')
+            # Only show the progress now and then, printing is slow compared to a rollout
+            if show_progress and rollout % 100 == 0:
+                print(f'Doing rollout {rollout} for {game_state.player_to_play.name}', end='\r')
             # Do the (IS)MCTS
-            leaf_node = self.select()
-            self.expand(leaf_node)
-            name_of_loser = self.simulate(leaf_node)
-            self.backpropagate(leaf_node, name_of_loser)
-        print(' '*50, end='\r')
+            leaf_node = select()
+            expand(leaf_node)
+            name_of_loser = simulate(leaf_node)
+            backpropagate(leaf_node, name_of_loser)
+        if show_progress:
+            print(' '*50, end='\r')
 
         # Return the information of each action with their performance
         dct = {}
-        for action_played, child in self.mctsnode.children.items():
+        for action_played, child in zip(self.mctsnode.actions, self.mctsnode.children):
             dct[action_played] = (child.W, child.N)
         # Clear cache
         self.mctsnode = None
         return dct
 
+    def do_parallel_rollouts(self, game_state, rollouts, expl_const, workers):
+        """Divides the rollouts over worker processes (root parallelization)"""
+        # Each worker grows its own tree from the game state with its own seed,
+        # afterwards the statistics of the actions from the root are summed.
+        seeds = [random.getrandbits(32) for _ in range(workers)]
+        jobs = [rollouts // workers + (worker < rollouts % workers) for worker in range(workers)]
+        dct = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for ratings in pool.map(rollout_worker, repeat(game_state), jobs, repeat(expl_const), seeds):
+                for action_played, (W, N) in ratings.items():
+                    total_W, total_N = dct.get(action_played, (0, 0))
+                    dct[action_played] = (total_W + W, total_N + N)
+        return dct
+
     def select(self):
         """Select a leaf node from the tree"""
         # Traverse the tree as long as possible
@@ -328,9 +405,13 @@ class MCTree:
                 return mctsnode
 
             # Otherwise, we go to a unexplored child
-            for action, node in mctsnode.children.items():
-                if not node.is_explored:
-                    break
+            children = mctsnode.children
+            idx = mctsnode.first_unexplored
+            while idx < len(children) and children[idx].is_explored:
+                idx += 1
+            mctsnode.first_unexplored = idx
+            if idx < len(children):
+                node = children[idx]
             else:
                 # If all children are explored, we select a child according
                 # to the UCT scoring.
@@ -341,42 +422,35 @@ class MCTree:
 
     def expand(self, leaf_node):
         """Expand the leaf node from the tree, i.e. simulate all possible actions"""
-        if leaf_node.is_end_state is None:
-            leaf_node.get_game_state()
+        # Every expanded node keeps its game state
+        game = leaf_node.store_game_state()
 
         if leaf_node.is_end_state:
             # Nothing to do
             return None
 
         # Simulate all possible actions
-        game = leaf_node.get_game_state()
         # Check which actions we're allowed to do
         allowed = game.allowed_plays()
         # Initialize the children of the leaf node
-        leaf_node.children = {action: MCNode(parent=leaf_node) for action in allowed}
+        for action in allowed:
+            leaf_node.add_child(action)
         leaf_node.is_explored = True
 
     def simulate(self, leaf_node):
         """Play random game until an end state is reached, return loser"""
-        assert leaf_node.is_end_state is not None
         if leaf_node.is_end_state:
             return leaf_node.get_game_state().loser.name
 
         # Choose a random action from the children of the leaf node
-        action = choose_random_action(list(leaf_node.children.keys()))
+        action = choose_random_action(leaf_node.actions)
         # Execute the action
-        game = leaf_node.get_game_state().make_deepcopy()
+        game = leaf_node.make_game_state()
         game.execute_action(action)
 
-        # Traverse the tree randomly
-        while not game.is_end_state:
-            # Execute a random allowed action
-            allowed = game.allowed_plays()
-            action = choose_random_action(allowed)
-            game.execute_action(action)
-
-        # Return the loser of the game (the name of since strings are immutable)
-        return game.loser.name
+        # Traverse the tree randomly and return the loser of the game
+        # (the name of since strings are immutable)
+        return game.play_randomly().name
 
     def backpropagate(self, mctsnode, name_of_loser):
         """Increases visit counts in the tree (and winning count, etc)"""
@@ -385,37 +459,51 @@ class MCTree:
             mctsnode.N += 1
 
             # Increase reward
-            if mctsnode.parent is not None:
-                # The player to play before he played the action (on the edge) is the one
-                # that has to choose the action to go to this node or not.
-                if mctsnode.parent.get_game_state().player_to_play.name != name_of_loser:
-                    # This person did not lose
-                    mctsnode.W += 1
-            mctsnode = mctsnode.parent
+            parent = mctsnode.parent
+            # The player to play before he played the action (on the edge) is the one
+            # that has to choose the action to go to this node or not. The parent
+            # is expanded, thus the name of this player is known.
+            if parent is not None and parent.player_name != name_of_loser:
+                # This person did not lose
+                mctsnode.W += 1
+            mctsnode = parent
 
 
 class ISMCNode(MCNode):
     """Game states from which the any player can choose an action"""
-    def uct_select(self, allowed_plays, expl_const):
-        # There are some children as this node is explored and non-terminal
-        kids = []
-        for action_played, mctsnode in self.children.items():
-            if action_played in allowed_plays:
-                N, W = mctsnode.N, mctsnode.W
-                if N > 0:  # If the child is traversed
-                    kids.append((action_played, N, W))
+    __slots__ = ('action_to_idx',)
+
+    def __init__(self, parent=None, game_state=None):
+        super().__init__(parent, game_state)
+        # The allowed plays differ per determinization, thus the children
+        # are also found by their action
+        self.action_to_idx = {}
 
-        assert self.N > 0  # Check if node is traversed
-        assert len(kids) > 0  # At least one of the children must be traversed
+    def add_child(self, action):
+        """Adds a new child reached by playing action, returns its index"""
+        idx = super().add_child(action)
+        self.action_to_idx[action] = idx
+        return idx
 
+    def uct_select(self, allowed_plays, expl_const):
+        """Returns the allowed (action, child) with the highest UCT score
+
+        The node must be traversed and at least one of the allowed children too.
+        """
+        # There are some children as this node is explored and non-terminal
         const = expl_const * sqrt(log(self.N))
-        def uct(args):
-            _, N, W = args
-            return W / N + const * N**(-.5)
+        allowed_plays = set(allowed_plays)
 
-        # Choose best kid
-        best = max(kids, key=uct)
-        return (best[0], self.children[best[0]])
+        # Choose the best allowed kid in a single pass
+        best_score, best_action, best_node = -1., None, None
+        for action_played, mctsnode in zip(self.actions, self.children):
+            N = mctsnode.N
+            if N > 0 and action_played in allowed_plays:  # If the child is traversed
+                score = mctsnode.W / N + const / sqrt(N)
+                if score > best_score:
+                    best_score, best_action, best_node = score, action_played, mctsnode
+
+        return (best_action, best_node)
 
 
 class ISMCTree:
@@ -425,32 +513,67 @@ class ISMCTree:
         self.mctsnode = None
         self.expl_const = .7
         self.player_name = None
-
+        # The root of the previous search and the history of its game state,
+        # its statistics are kept if the game continues from there.
+        self.previous_root = None
+        self.previous_history = []
+
+    def reuse_subtree(self, game_state):
+        """Returns the node of the previous search for game_state (or a new node)"""
+        mctsnode = self.previous_root
+        num_previous = len(self.previous_history)
+        if mctsnode is None or game_state.history[:num_previous] != self.previous_history:
+            return ISMCNode(game_state=game_state)
+        # Follow the actions played since the previous search
+        for action in game_state.history[num_previous:]:
+            idx = mctsnode.action_to_idx.get((action[0], action[1]))
+            if idx is None:
+                # This part of the game was never searched
+                return ISMCNode(game_state=game_state)
+            mctsnode = mctsnode.children[idx]
+        # The stored game states were made with the knowledge of the previous
+        # root, the descendants are made from the new root state instead.
+        mctsnode.forget_game_states()
+        # The node becomes the root of the tree
+        mctsnode.parent = None
+        mctsnode.game_state = game_state
+        mctsnode.is_end_state = game_state.is_end_state
+        mctsnode.player_name = game_state.player_to_play.name
+        return mctsnode
 
     def do_rollouts(self, game_state, rollouts=1000, expl_const=.7):
         """We traverse this tree where each node is the state from which
         the player (the perspective player) can choose an action.
         """
         self.expl_const = expl_const
-        # TODO: This search tree can be reused
-        # Create a new node
-        self.mctsnode = ISMCNode(game_state=game_state)
+        # Continue with the subtree of the previous search (or create a new node)
+        self.mctsnode = self.reuse_subtree(game_state)
 
         # Perform the rollouts/traversals
+        # (the steps are bound once, not looked up on every rollout)
+        select, expand, simulate, backpropagate = self.select, self.expand, self.simulate, self.backpropagate
         for rollout in range(rollouts):
-            print(f'Doing rollout {rollout} for {game_state.player_to_play.name}', end='\r')
+            # Only show the progress now and then, printing is slow compared to a rollout
+            if rollout % 100 == 0:
+                print(f'Doing rollout {rollout} for {game_state.player_to_play.name}', end='\r')
             # Do the (IS)MCTS
-            leaf_node = self.select()
-            self.expand(leaf_node)
-            name_of_loser = self.simulate(leaf_node)
-            self.backpropagate(leaf_node, name_of_loser)
+            leaf_node = select()
+            expand(leaf_node)
+            name_of_loser = simulate(leaf_node)
+            backpropagate(leaf_node, name_of_loser)
         print(' '*50, end='\r')
 
-        # Return the information of each action with their performance
+        # Return the information of each action with their performance,
+        # a reused root can also have children that were only allowed in
+        # other determinizations of the hand of this player.
+        allowed = {(action[0], action[1]) for action in game_state.allowed_plays()}
         dct = {}
-        for action_played, child in self.mctsnode.children.items():
-            dct[action_played] = (child.W, child.N)
-        # Clear cache
+        for action_played, child in zip(self.mctsnode.actions, self.mctsnode.children):
+            if action_played in allowed:
+                dct[action_played] = (child.W, child.N)
+        # Keep the tree for the next search
+        self.previous_root = self.mctsnode
+        self.previous_history = game_state.history.copy()
         self.mctsnode = None
         return dct
 
@@ -475,18 +598,26 @@ class ISMCTree:
                 return mctsnode
 
             # Otherwise, determinize the game
-            copied = mctsnode.get_game_state().make_deepcopy()
-            copied.player_to_play.determinize_hand(copied)
-            allowed = copied.allowed_plays()
-            allowed = [(i[0], i[1]) for i in allowed]  # stripped weights
+            allowed = mctsnode.allowed
+            if allowed is None:
+                copied = mctsnode.make_game_state()
+                # If the whole hand is known, every determinization allows the same plays
+                hand_is_known = not any(card.is_unknown for card in copied.player_to_play.hand)
+                copied.player_to_play.determinize_hand(copied)
+                allowed = copied.allowed_plays()
+                allowed = [(i[0], i[1]) for i in allowed]  # stripped weights
+                if hand_is_known:
+                    mctsnode.allowed = allowed
             # Choose an unexplored allowed play
+            action_to_idx = mctsnode.action_to_idx
             for action in allowed:
+                idx = action_to_idx.get(action)
                 # Unforseen child (ThrowCards propably)
-                if action not in mctsnode.children:
-                    mctsnode.children[action] = ISMCNode(parent=mctsnode)
+                if idx is None:
+                    idx = mctsnode.add_child(action)
                 # Check if the child is unexplored
-                if not mctsnode.children[action].is_explored:
-                    node = mctsnode.children[action]
+                node = mctsnode.children[idx]
+                if not node.is_explored:
                     break
             else:
                 # If all children are explored, we select a child according
@@ -498,46 +629,39 @@ class ISMCTree:
 
     def expand(self, leaf_node):
         """Expand the leaf node from the tree, i.e. simulate all possible actions"""
-        if leaf_node.is_end_state is None:
-            leaf_node.get_game_state()
+        # Every expanded node keeps its game state
+        game = leaf_node.store_game_state()
 
         if leaf_node.is_end_state:
             # Nothing to do
             return None
 
         # Simulate all possible actions
-        game = leaf_node.get_game_state()
         # Check which actions we're allowed to do
         allowed = game.allowed_plays()
         # Initialize the children of the leaf node
-        leaf_node.children = {(action[0], action[1]): ISMCNode(parent=leaf_node) for action in allowed}
+        for action in allowed:
+            leaf_node.add_child((action[0], action[1]))
         leaf_node.is_explored = True
 
     def simulate(self, leaf_node):
         """Play random game until an end state is reached, return loser"""
-        assert leaf_node.is_end_state is not None
         if leaf_node.is_end_state:
             return leaf_node.get_game_state().loser.name
 
         # Determinize
-        copied = leaf_node.get_game_state().make_deepcopy()
+        game = leaf_node.make_game_state()
+        copied = game.make_deepcopy()
         copied.player_to_play.determinize_hand(copied)
         allowed = copied.allowed_plays()
         # Choose a random allowed action (with this determinization)
         action = choose_random_action(allowed)
         # Execute the action
-        game = leaf_node.get_game_state().make_deepcopy()
         game.execute_action(action)
 
-        # Traverse the tree randomly
-        while not game.is_end_state:
-            # Execute a random allowed action
-            allowed = game.allowed_plays()
-            action = choose_random_action(allowed)
-            game.execute_action(action)
-
-        # Return the loser of the game (the name of since strings are immutable)
-        return game.loser.name
+        # Traverse the tree randomly and return the loser of the game
+        # (the name of since strings are immutable)
+        return game.play_randomly().name
 
     def backpropagate(self, mctsnode, name_of_loser):
         """Increases visit counts in the tree (and winning count, etc)"""
@@ -546,11 +670,12 @@ class ISMCTree:
             mctsnode.N += 1
 
             # Increase reward
-            if mctsnode.parent is not None:
-                # The player to play before he played the action (on the edge) is the one
-                # that has to choose the action to go to this node or not.
-                if mctsnode.parent.get_game_state().player_to_play.name != name_of_loser:
-                    # This person did not lose
-                    mctsnode.W += 1
-            mctsnode = mctsnode.parent
+            parent = mctsnode.parent
+            # The player to play before he played the action (on the edge) is the one
+            # that has to choose the action to go to this node or not. The parent
+            # is expanded, thus the name of this player is known.
+            if parent is not None and parent.player_name != name_of_loser:
+                # This person did not lose
+                mctsnode.W += 1
+            mctsnode = parent
 
@@ -1,13 +1,17 @@
 from abc import ABC, abstractmethod
-from itertools import permutations
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import random
 
 from tools import Card
-from tools import choose_random, choose_random_action
+from tools import choose_random_action, choose_random_card
+from tools import card_bit, iter_cards, popcount
 from mcts import MCTreeFPV, MCTree, ISMCTree
 
 
 class Player(ABC):
+    __slots__ = ('name', 'hand')
+
     def __init__(self, name):
         self.name = name
         self.hand = []
@@ -44,39 +48,48 @@ class Player(ABC):
                 # check the options for the cards
                 unknown = game_state.get_unknown_cards()
                 if game_state.computer_shuffle:
-                    card.from_suit_value(*choose_random(unknown))
+                    card.from_suit_value(*choose_random_card(unknown))
                 else:
                     print(f'{self} has drawn card')
-                    card.from_input(unknown)
-                card.is_private = True
+                    card.from_input(set(iter_cards(unknown)))
+                game_state.mark_private(card)
+
+    def hand_mask(self):
+        """Returns the bitboard of the known cards in the hand of this person"""
+        mask = 0
+        for card in self.hand:
+            if not card.is_unknown:
+                mask |= card_bit(card.suit, card.value)
+        return mask
 
     def possible_card_plays(self, non_public_cards):
-        """Returns the (suit, value) pairs this person can play from his hand"""
-        poss_plays = set()
+        """Returns the bitboard of the cards this person can play from his hand"""
+        poss_plays = 0
         for card in self.hand:
             if card.is_unknown:
                 # This card cannot be public and cannot be in the current hand,
                 # however, since the private hand will be added, these cards
                 # are not dealt with separately.
-                poss_plays.update(non_public_cards)
+                poss_plays |= non_public_cards
             else:
                 # This card is either public or private and known to this person
-                poss_plays.add((card.suit, card.value))
+                poss_plays |= card_bit(card.suit, card.value)
         return poss_plays
 
     def discard_card(self, game_state, suit, value, remove=True):
         """Discards the card from the hand with suit and value"""
+        bit = card_bit(suit, value)
+        # Check if (suit, value) pair in unknown cards (to this player)
+        # The unknown cards to this player are all non-public cards minus cards
+        # in the (known) hand of this player (checked once, not for every card)
+        is_unknown_to_player = bit & game_state.get_non_public_cards() and not bit & self.hand_mask()
         for idx, card in enumerate(self.hand):
             if card.is_unknown:
-                # Check if (suit, value) pair in unknown cards (to this player)
-                # The unknown cards to this player are all non-public cards minus cards
-                # in the (known) hand of this player
-                if (suit, value) in game_state.get_non_public_cards():
-                    if (suit, value) not in [(c.suit, c.value) for c in self.hand if not c.is_unknown]:
-                        # Define the unknown card to be this card
-                        card.suit = suit
-                        card.value = value
-                        break
+                if is_unknown_to_player:
+                    # Define the unknown card to be this card
+                    card.suit = suit
+                    card.value = value
+                    break
             else:
                 if card.suit == suit and card.value == value:
                     break
@@ -86,63 +99,26 @@ class Player(ABC):
             card_played = self.hand.pop(idx)
         else:
             card_played = self.hand[idx]
-        card_played.is_unknown = False
-        card_played.is_private = False
-        card_played.is_public = True
+        game_state.mark_public(card_played)
         return card_played
 
-    def can_throw(self, fallback_identities, cards):
-        """Checks if this player can throw away cards"""
-        # fallback identities are the options of the cards if it is unknown
-        poss = []
-        cards_set = set(cards)
+    def can_throw(self, fallback_identities, cards_mask):
+        """Checks if this player can throw away the cards in cards_mask (bitboard)"""
+        # fallback identities are the options of the cards if it is unknown (bitboard)
+        known = 0
         fallback = 0
         for card in self.hand:
             if card.is_unknown:
                 fallback += 1
             else:
-                identity = (card.suit, card.value)
-
-                # Check if this card has an identity that match a card in cards
-                if identity in cards_set:
-                    poss.append({identity})
-        # Easy case, poss is not big enough to consist of len(cards) cards
-        # if len(poss) < len(cards):
-        if len(poss) + fallback < len(cards):
+                known |= card_bit(card.suit, card.value)
+        # Every known card matches only itself, the other cards must each be
+        # matched by a different unknown card (all of which have the same
+        # fallback identities, so by Hall's theorem counting them suffices).
+        missing = cards_mask & ~known
+        if missing & ~fallback_identities:
             return False
-        # Add fallbacks, the minimum amount needed
-        poss += [fallback_identities.copy() for _ in range(min(fallback, len(cards)))]
-        ### We need to check if we can play cards, having poss
-        # # Easy case, one of the cards is not in poss
-        # p = set()
-        # for i in poss:
-        #     p = p.union(i)
-        # for c in cards:
-        #     if c not in p:
-        #         return False
-        # Greedy approach: take the nth card from the first allowed poss
-        poss2 = [i.copy() for i in poss]
-        for c in cards:
-            for idx, p in enumerate(poss2):
-                if c in p:
-                    poss2.pop(idx)
-                    break
-            else:
-                return False
-        return True
-
-        # # Otherwise iterating through all options
-        # # -> takes a long time
-        # for _ in range(len(poss) - len(cards)):
-        #     cards.append(0)
-        # for perm in permutations(cards, r=len(cards)):
-        #     # print(perm, poss)
-        #     for idx, card in enumerate(perm):
-        #         if card != 0 and card not in poss[idx]:
-        #             break
-        #     else:
-        #         return True
-        # return False
+        return popcount(missing) <= fallback
 
     def determinize_hand(self, game_state):
         """Returns a possible determinization for the hand of this player"""
@@ -152,16 +128,15 @@ class Player(ABC):
             if card.is_unknown:
                 unknown_cards.append(card)
             else:
-                card.is_private = False
-                card.is_public = True
+                game_state.mark_public(card)
         # Check if we need to do anything
         if len(unknown_cards) > 0:
-            # We pop from all the unknown cards as possible cards
-            unknown = list(game_state.get_non_public_cards())
-            for unknown_card in unknown_cards:
-                suit, value = unknown.pop(random.randint(0, len(unknown)-1))
+            # We draw from all the unknown cards as possible cards (in a single call)
+            unknown = list(iter_cards(game_state.get_non_public_cards()))
+            drawn = random.sample(unknown, len(unknown_cards))
+            for unknown_card, (suit, value) in zip(unknown_cards, drawn):
                 unknown_card.from_suit_value(suit, value)
-                unknown_card.is_public = True
+                game_state.mark_public(unknown_card)
 
     @abstractmethod
     def choose_action(self, game_state):
@@ -172,6 +147,8 @@ class Player(ABC):
         """Returns a copy of self (without copying the cards in the hand)"""
 
 class Random(Player):
+    __slots__ = ()
+
     def make_copy(self):
         new = Random(self.name)
         new.hand = self.hand.copy()
@@ -190,6 +167,8 @@ class Random(Player):
 
 
 class Human(Player):
+    __slots__ = ()
+
     def make_copy(self):
         new = Human(self.name)
         new.hand = self.hand.copy()
@@ -262,6 +241,8 @@ class ISMCTSFPV(Player):
     in which the perspective player is to play, and edges the combined moves
     of the perspective player and all others untill the perspective players turn.
     """
+    __slots__ = ('tree', 'rollouts', 'expl_const')
+
     def __init__(self, name, rollouts=1000, expl_const=.7, scoring='Winning percentage'):
         self.name = name
         self.hand = []
@@ -297,10 +278,7 @@ class ISMCTSFPV(Player):
         # We must view everything from the perspective of this player
         # thus all the private cards in others people hands are reset
         # since they are unknown to us.
-        for card in copied_state.card_collection:
-            if card.is_private and card not in self.hand:
-                # Reset value (keeping the same memory address)
-                card.reset()
+        copied_state.mark_private_unknown(keep_mask=self.hand_mask())
 
         # Do rollouts
         search_tree.do_rollouts(copied_state, self.rollouts, self.expl_const)
@@ -329,7 +307,9 @@ class DeterminizedMCTS(Player):
     This means that for a game like bridge, regular MCTS is used after a random
     sample is taken from the possible hands of the other players.
     """
-    def __init__(self, name, deals=10, rollouts=100, expl_const=.7, scoring='Winning percentage'):
+    __slots__ = ('tree', 'scoring', 'rollouts', 'deals', 'expl_const', 'workers')
+
+    def __init__(self, name, deals=10, rollouts=100, expl_const=.7, scoring='Winning percentage', workers=1):
         self.name = name
         self.hand = []
         self.tree = MCTree()
@@ -337,6 +317,7 @@ class DeterminizedMCTS(Player):
         self.rollouts = rollouts  # number of rollouts per deal
         self.deals = deals
         self.expl_const = expl_const
+        self.workers = workers  # number of processes that share the deals (or the rollouts of one deal)
 
     def make_copy(self):
         new = DeterminizedMCTS(self.name)
@@ -347,28 +328,53 @@ class DeterminizedMCTS(Player):
         """We make a random deal on the card collection as determinization"""
         # First, we make every card in our hand public
         for card in game_state.player_to_play.hand:
-            card.is_private = False
-            card.is_public = True
+            game_state.mark_public(card)
         # We shuffle all the unknown cards (including private cards in other hands)
-        unknown = list(game_state.get_non_public_cards())
+        unknown = list(iter_cards(game_state.get_non_public_cards()))
         random.shuffle(unknown)
+        # From our perspective the private cards are unknown, they are forgotten
+        # before dealing as a dealt card can be the old identity of a later card
+        for card in game_state.card_collection:
+            if card.is_private:
+                game_state.known_mask &= ~card_bit(card.suit, card.value)
+        # The shuffled cards are dealt in order (without popping from the front)
+        unknown = iter(unknown)
         # We define the unknown cards in the card_collection as a random card
         for card in game_state.card_collection:
             if card.is_unknown:
                 # We set this card to suit and value
-                suit, value = unknown.pop(0)
+                suit, value = next(unknown)
                 card.from_suit_value(suit, value)
-                card.is_public = True
+                game_state.mark_public(card)
             elif card.is_private:
                 # We set this card to suit and value
-                suit, value = unknown.pop(0)
-                card.is_private = False
-                card.is_unknown = True  # From our perspective the card in unknown
-                card.from_suit_value(suit, value)
-                card.is_public = True
+                suit, value = next(unknown)
+                card.suit = suit
+                card.value = value
+                game_state.mark_public(card)
         # Now we have all different, all public cards
         return game_state
 
+    def do_deals(self, game_state, search_tree):
+        """Yields the ratings of the actions for each random deal of game_state"""
+        # The search only changes copies of the determinized state, thus the
+        # determinization is undone after each deal instead of copying the state
+        undetermined = game_state.save_card_states()
+        for deal in range(self.deals):
+            # Determinize the state
+            copied = self.random_deal(game_state)
+            # Do rollouts
+            yield search_tree.do_rollouts(copied, self.rollouts, self.expl_const, self.workers)
+            # Undo the determinization for the next deal
+            game_state.restore_card_states(undetermined)
+
+    def do_parallel_deals(self, game_state):
+        """Returns the ratings of the actions for each random deal of game_state,
+        the deals are searched in worker processes (root parallelization)"""
+        seeds = [random.getrandbits(32) for _ in range(self.deals)]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(deal_worker, repeat(self), repeat(game_state), seeds))
+
     def choose_action(self, game_state):
         # Choose an action from all allowed actions
         # by using a determinized Monte Carlo Tree Search.
@@ -386,30 +392,28 @@ class DeterminizedMCTS(Player):
         # We must view everything from the perspective of this player
         # thus all the private cards in others people hands are reset
         # since they are unknown to us.
+        # From this point on we do not want to change the original game state
+        # NOTE: Doing this also changes this class to a new player class.
+        #       ->  Be careful! Only compare names from this point forward.
         copied_state = game_state.make_deepcopy()
-        for card in copied_state.card_collection:
-            if card.is_private and card not in self.hand:
-                # Reset value (keeping the same memory address)
-                card.reset()
+        copied_state.mark_private_unknown(keep_mask=self.hand_mask())
 
+        # Retrieve the search tree from previous iterations,
+        # the same tree is used for every deal
+        search_tree = game_state.player_to_play.tree
+        if self.workers > 1 and self.deals > 1:
+            # The deals are independent, thus they are divided over worker processes
+            deal_ratings = self.do_parallel_deals(copied_state)
+        else:
+            # A single deal divides its rollouts over the workers instead
+            deal_ratings = self.do_deals(copied_state, search_tree)
+        # The summed [W, N] of each action over all deals
         total_ratings = {}
-        for deal in range(self.deals):
-            # From this point on we do not want to change the original game state
-            # NOTE: Doing this also changes this class to a new player class.
-            #       ->  Be careful! Only compare names from this point forward.
-            copied = copied_state.make_deepcopy()
-            # Determinize the state
-            copied = self.random_deal(copied)
-            # Retrieve the search tree from previous iterations
-            search_tree = game_state.player_to_play.tree
-            # Do rollouts
-            action_ratings = search_tree.do_rollouts(copied, self.rollouts, self.expl_const)
+        for action_ratings in deal_ratings:
             for action, (W, N) in action_ratings.items():
-                if action not in total_ratings:
-                    total_ratings[action] = [W, N]
-                else:
-                    total_ratings[action][0] += W
-                    total_ratings[action][1] += N
+                ratings = total_ratings.setdefault(action, [0, 0])
+                ratings[0] += W
+                ratings[1] += N
 
         # We choose the action to perform based on the total statistics
         if self.scoring == 'Visit count':
@@ -430,12 +434,22 @@ class DeterminizedMCTS(Player):
         return action_to_play
 
 
+def deal_worker(player, game_state, seed):
+    """Searches a random deal of game_state in a worker process, returns the ratings"""
+    random.seed(seed)
+    copied = player.random_deal(game_state)
+    # The worker is already one of the processes, thus it does not start a pool of its own
+    return MCTree().do_rollouts(copied, player.rollouts, player.expl_const, workers=1, show_progress=False)
+
+
 class ISMCTS(Player):
     """
     For each node we find all children
     afterwards we deal a random hand (determinize) and from it play the
     unexplored / best action, afterwards we remove the determinization for the next player.
     """
+    __slots__ = ('tree', 'scoring', 'rollouts', 'expl_const')
+
     def __init__(self, name, rollouts=100, expl_const=.7, scoring='Winning percentage'):
         self.name = name
         self.hand = []
@@ -470,10 +484,7 @@ class ISMCTS(Player):
         # We must view everything from the perspective of this player
         # thus all the private cards in others people hands are reset
         # since they are unknown to us.
-        for card in copied.card_collection:
-            if card.is_private and card not in self.hand:
-                # Reset value (keeping the same memory address)
-                card.reset()
+        copied.mark_private_unknown(keep_mask=self.hand_mask())
         # Retrieve the search tree from previous iterations
         search_tree = game_state.player_to_play.tree
         # Do rollouts
@@ -1,25 +1,62 @@
 import random
 
 
-def choose_random(lst, weights=None):
-    """Choose a random element"""
-    if weights is None:
-        return random.choice(list(lst))
-    else:
-        return random.choices(list(lst))[0]
+# A collection of cards is stored as a bitboard (an int with one bit per card),
+# the card (suit, value) is stored at bit index suit*9 + value.
+FULL_MASK = (1 << 36) - 1  # all 36 cards
+# Maps a 9-bit mask of values to the bitboard of all cards with those values
+EXPAND_VALUES = [vmask | vmask << 9 | vmask << 18 | vmask << 27 for vmask in range(1 << 9)]
+# The printed suit and value of each card, indexed as the bits of a bitboard
+CARD_STRINGS = ['♣♠♥♦'[suit] + '6789*JQKA'[value] for suit in range(4) for value in range(9)]
+
+
+def card_bit(suit, value):
+    """Returns the bitboard containing only the (suit, value) card"""
+    return 1 << (suit * 9 + value)
+
+def iter_bits(mask):
+    """Yields the indices of the set bits of the mask"""
+    while mask:
+        # Isolate the lowest set bit
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def iter_cards(mask):
+    """Yields the (suit, value) pairs of the cards in the bitboard"""
+    while mask:
+        # Isolate the lowest set bit
+        low = mask & -mask
+        yield divmod(low.bit_length() - 1, 9)
+        mask ^= low
+
+def popcount(mask):
+    """Returns the number of set bits of the mask"""
+    return bin(mask).count('1')
+
+
+def choose_random_card(mask):
+    """Returns the (suit, value) of a random card in the bitboard"""
+    # Draw which of the set bits is chosen (as random.choice would do on the
+    # list of cards) and clear the lower set bits, without building the list
+    for _ in range(random.randrange(popcount(mask))):
+        mask &= mask - 1
+    return divmod((mask & -mask).bit_length() - 1, 9)
 
 def choose_random_action(poss_actions):
     """Returns a random action from poss_actions with and without weights"""
+    # The actions are drawn directly from poss_actions (a list or tuple),
+    # without building intermediate lists.
     # Check if we used weights
     if len(poss_actions[0]) == 3:
-        # Weights are used
-        return choose_random(
-                list(map(lambda x: (x[0], x[1]), poss_actions)),
-                weights=list(map(lambda x: x[2], poss_actions))
-            )
+        # Weights are used, the action is returned without its weight
+        # NOTE: the weights are not passed to random.choices, thus every
+        #       action is drawn with the same probability
+        action = random.choices(poss_actions)[0]
+        return (action[0], action[1])
     else:
         # Weights are not used
-        return choose_random(poss_actions)
+        return random.choice(poss_actions)
 
 
 class Card:
@@ -29,13 +66,17 @@ class Card:
     private to the one holding the card
     or known to all.
     """
-    suit = None
-    value = None
-    trump_suit = None
-    # There is always one (and only one) of the following true
-    is_public = False  # does everyone know the card
-    is_private = False  # does the person holding the card know its value
-    is_unknown = True  # does no one know the card
+    __slots__ = ('suit', 'value', 'trump_suit', 'idx', 'is_public', 'is_private', 'is_unknown')
+
+    def __init__(self):
+        self.suit = None
+        self.value = None
+        self.trump_suit = None
+        self.idx = None  # position of the card in the card collection of the game
+        # There is always one (and only one) of the following true
+        self.is_public = False  # does everyone know the card
+        self.is_private = False  # does the person holding the card know its value
+        self.is_unknown = True  # does no one know the card
 
     def __str__(self):
         if self.is_unknown:
@@ -46,9 +87,7 @@ class Card:
             else:
                 string = 'A'
             assert self.suit is not None  # thought this was not unknown
-            string += '♣♠♥♦'[self.suit]
-            string += '6789*JQKA'[self.value]
-            return string
+            return string + CARD_STRINGS[self.suit * 9 + self.value]
 
     def __eq__(self, other):
         return self.suit == other.suit and self.value == other.value
@@ -68,6 +107,7 @@ class Card:
     def make_copy(self):
         """Returns a copy of the card"""
         new = Card()
+        new.idx = self.idx
         new.suit = self.suit
         new.value = self.value
         new.trump_suit = self.trump_suit
@@ -76,10 +116,6 @@ class Card:
         new.is_unknown = self.is_unknown
         return new
 
-    def is_trump(self):
-        """Checks if the current card is a trump card or not"""
-        return self.suit == self.trump_suit
-
     def from_input(self, possible):
         """Get the suit and value of the card from the input
 